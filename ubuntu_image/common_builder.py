@@ -563,6 +563,8 @@ class AbstractImageBuilderState(State):
                     part.name is None):
                 part.name = 'writable'
             image.partition(part.offset, part.size, part.name, activate)
+        # Write the whole partition table out in one go.
+        image.commit()
         # Now since we're done, we need to do a second pass to copy the data
         # and set all the partition types.  This needs to be done like this as
         # libparted's commit() operation resets type GUIDs to defaults and
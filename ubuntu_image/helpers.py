@@ -9,8 +9,8 @@ import logging
 import contextlib
 
 from contextlib import ExitStack, contextmanager
-from distutils.spawn import find_executable
 from parted import Device
+from shutil import which as find_executable
 from subprocess import DEVNULL, PIPE, run as subprocess_run
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from ubuntu_image.state import ExpectedError
@@ -66,16 +66,20 @@ def straight_up_bytes(count):
     return count
 
 
+SIZE_RE = re.compile(r'(\d+)([a-zA-Z]*)')
+SIZE_UNITS = {
+    '': straight_up_bytes,
+    'G': GiB,
+    'M': MiB,
+    }
+
+
 def as_size(size, min=0, max=None):
-    mo = re.match(r'(\d+)([a-zA-Z]*)', size)
+    mo = SIZE_RE.match(size)
     if mo is None:
         raise ValueError(size)
     size_in_bytes = mo.group(1)
-    value = {
-        '': straight_up_bytes,
-        'G': GiB,
-        'M': MiB,
-        }[mo.group(2)](int(size_in_bytes))
+    value = SIZE_UNITS[mo.group(2)](int(size_in_bytes))
     if max is None:
         if value < min:
             raise ValueError('Value outside range: {} < {}'.format(value, min))
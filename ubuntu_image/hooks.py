@@ -10,6 +10,7 @@ variables."""
 import os
 import logging
 
+from operator import attrgetter
 from ubuntu_image.helpers import run
 from ubuntu_image.state import ExpectedError
 
@@ -48,10 +49,9 @@ class HookManager:
         if proc.returncode != 0:
             raise HookError(name, path, proc.returncode, proc.stderr)
 
-    def fire(self, name, overlay_env={}):
-        """Method called to run a specified hook."""
-        env = os.environ.copy()
-        env.update(overlay_env)
+    def _find_hooks(self, name):
+        """Return the paths of all the scripts for a hook, in run order."""
+        hooks = []
         name_d = '{}.d'.format(name)
         for hook_dir in self._hook_dirs:
             # Hook scripts can be either present in the hook directory as
@@ -59,9 +59,18 @@ class HookManager:
             # We go and execute all of them in the order directory > file.
             abspath = os.path.join(hook_dir, name_d)
             if os.path.isdir(abspath):
-                for hook in sorted(os.listdir(abspath)):
-                    abspath_d = os.path.join(name, abspath, hook)
-                    self._run_hook(name, abspath_d, env)
+                # The DirEntry objects already carry the full path, so there
+                # is no need to join each name back onto the directory.
+                entries = sorted(os.scandir(abspath), key=attrgetter('name'))
+                hooks.extend(entry.path for entry in entries)
             abspath = os.path.join(hook_dir, name)
             if os.path.isfile(abspath):
-                self._run_hook(name, abspath, env)
+                hooks.append(abspath)
+        return hooks
+
+    def fire(self, name, overlay_env={}):
+        """Method called to run a specified hook."""
+        env = os.environ.copy()
+        env.update(overlay_env)
+        for path in self._find_hooks(name):
+            self._run_hook(name, path, env)
@@ -5,12 +5,84 @@ import parted
 
 from json import loads as load_json
 from math import ceil
-from struct import pack
-from ubuntu_image.helpers import run
+from struct import Struct
+from ubuntu_image.helpers import MiB, run
 from ubuntu_image.parser import VolumeSchema
+from uuid import UUID
+from zlib import crc32
 
 
 COMMASPACE = ', '
+# The MBR partition table starts at this byte offset into the disk and
+# consists of four 16-byte entries, the fifth byte of which is the type.
+MBR_TABLE_OFFSET = 446
+MBR_ENTRY_SIZE = 16
+MBR_TYPE_OFFSET = 4
+# The GPT header lives in the second sector of the disk, with a backup copy
+# in the last sector.  The type GUID is the first field of each partition
+# entry.  The headers carry CRC32s both of themselves, with the CRC field
+# zeroed, and of the whole partition entry array.
+GPT_HEADER_LBA = 1
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = Struct('<8sIII4xQQQQ16sQIII')
+GPT_HEADER_CRC_OFFSET = 16
+# How much of a blob to read at a time when copying it into an image.
+COPY_CHUNK_SIZE = MiB(1)
+# Values written by write_value_at_offset() are little-endian 32-bit ints.
+UINT32_LE = Struct('<I')
+
+
+def _data_runs(data, bs):
+    """Yield (start, end) ranges of the blocks in data with any non-NUL bytes.
+
+    Adjacent such blocks are merged into a single range.  The last block
+    may be shorter than the block size.
+    """
+    # Multi-GiB partition images get copied with a 512 byte block size, so
+    # rather than looking at each block in turn, find the boundaries of the
+    # runs with bytes.startswith() and bytes.find(), which compare in C.
+    # Slices of the memoryview are NUL prefixes of any length, without
+    # copying.
+    nuls = memoryview(bytes(len(data)))
+    nul_block = bytes(bs)
+    size = len(data)
+    tail = size % bs
+    if tail > 0 and data.count(0, size - tail) == tail:
+        # The short final block is all NULs, so it gets skipped too.
+        size -= tail
+    pos = 0
+    while pos < size:
+        # Skip over the NUL blocks, in strides which double while they stay
+        # all NULs and halve again once they don't.
+        stride = bs
+        while pos < size:
+            end = min(pos + stride, size)
+            if data.startswith(nuls[:end - pos], pos):
+                pos = end
+                stride *= 2
+            elif stride > bs:
+                stride //= 2
+            else:
+                break
+        if pos >= size:
+            return
+        run_start = pos
+        # The run ends at the next all-NUL block.  A stretch of bs NULs
+        # need not be block aligned, so check the block boundary following
+        # each one that's found.
+        run_end = size
+        search = run_start + bs
+        while search < size:
+            found = data.find(nul_block, search, size)
+            if found < 0:
+                break
+            block_start = found + -found % bs
+            if data[block_start:block_start + bs] == nul_block:
+                run_end = block_start
+                break
+            search = block_start + 1
+        yield run_start, run_end
+        pos = run_end
 
 
 class Image:
@@ -29,15 +101,18 @@ class Image:
         * path - Path to the image file.
         """
         self.path = path
-        # Create an empty image file of a fixed size.  Unlike
-        # truncate(1) --size 0, os.truncate(path, 0) doesn't touch the
-        # file; i.e. it must already exist.
-        with open(path, 'wb'):
-            pass
-        # Truncate to zero, so that extending the size in the next call
-        # will cause all the bytes to read as zero.  Stevens $4.13
-        os.truncate(path, 0)
-        os.truncate(path, size)
+        # Whether partition() calls have been made since the partition table
+        # was last written out.
+        self._uncommitted = False
+        # Create an empty image file of a fixed size.  O_TRUNC first cuts any
+        # existing file to zero, so that extending the size with ftruncate()
+        # will cause all the bytes to read as zero (Stevens $4.13).  This
+        # leaves the file sparse, so it costs the same no matter the size.
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
         # Prepare the device and disk objects for parted to be used for all
         # future partition() calls.  Only do it if we actually care about the
         # partition table.
@@ -53,28 +128,61 @@ class Image:
             self.disk = parted.freshDisk(self.device, label)
             self.sector_size = self.device.sectorSize
 
-    def copy_blob(self, blob_path, **dd_args):
+    def copy_blob(self, blob_path, *, bs=512, count=None, seek=0, conv=''):
         """Copy a blob to the image file.
 
-        The copy is done using ``dd`` for consistency.  The keyword arguments
-        are passed directly to the ``dd`` call.  See the dd(1) manpage for
-        details.
+        The copy is done in-process, with the same semantics as ``dd
+        if=<blob_path> of=<image> conv=sparse`` given the block size, count,
+        seek and conversions keyword arguments.  See the dd(1) manpage for
+        details.  As with dd's sparse conversion, blocks of the blob which
+        are all NUL bytes are skipped over rather than written.
 
         :param blob_path: File system path to the input file.
         :type blob_path: str
+        :param bs: The block size in bytes.
+        :type bs: int
+        :param count: The number of blocks to copy, or None to copy the
+            whole blob.
+        :type count: int
+        :param seek: The number of blocks to skip at the start of the image.
+        :type seek: int
+        :param conv: Comma separated dd conversions; only ``notrunc`` and
+            ``sparse`` are supported.
+        :type conv: str
         """
-        # Put together the dd command.
-        args = ['dd', 'of={}'.format(self.path), 'if={}'.format(blob_path),
-                'conv=sparse']
-        for key, value in dd_args.items():
-            args.append('{}={}'.format(key, value))
-        # Run the command.  We'll capture stderr for logging purposes.
-        #
-        # TBD:
-        # - check status of the returned CompletedProcess
-        # - handle errors
-        # - log stdout/stderr
-        run(args)
+        self.commit()
+        conversions = set(filter(None, conv.split(',')))
+        unsupported = conversions - {'notrunc', 'sparse'}
+        if len(unsupported) > 0:
+            raise ValueError('Unsupported conversions: {}'.format(
+                COMMASPACE.join(sorted(unsupported))))
+        start = offset = seek * bs
+        remaining = None if count is None else count * bs
+        # Read in chunks of whole blocks so that blocks never straddle reads.
+        chunk_size = bs * max(1, COPY_CHUNK_SIZE // bs)
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            if 'notrunc' not in conversions:
+                os.ftruncate(fd, offset)
+            with open(blob_path, 'rb') as fp:
+                while remaining is None or remaining > 0:
+                    data = fp.read(
+                        chunk_size if remaining is None
+                        else min(chunk_size, remaining))
+                    if len(data) == 0:
+                        break
+                    for run_start, run_end in _data_runs(data, bs):
+                        os.pwrite(fd, data[run_start:run_end],
+                                  offset + run_start)
+                    offset += len(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+            # Like dd, make sure the image is at least as long as the copy
+            # even when the trailing blocks were skipped over.
+            if offset > start and os.fstat(fd).st_size < offset:
+                os.ftruncate(fd, offset)
+        finally:
+            os.close(fd)
 
     def partition(self, offset, size, name=None, is_bootable=False):
         """Add a new partition in the image file.
@@ -88,6 +196,11 @@ class Image:
         hybrid MBR in GPT labels so be sure to first perform partitioning and
         only afterwards attempting copy operations.
 
+        The new partition is only written to the image file on the next
+        commit(), which happens implicitly before any operation that reads
+        or writes the image file, so that consecutive partition() calls
+        write the partition table out only once.
+
         :param offset: Offset (start position) of the partition in bytes.
         :type offset: int
         :param size: Size of partition in bytes.
@@ -126,26 +239,86 @@ class Image:
             partition._Partition__partition.set_name(name)
         if is_bootable:
             partition.setFlag(parted.PARTITION_BOOT)
-        # Save all the partition changes so far to disk.
-        self.disk.commit()
+        self._uncommitted = True
+
+    def commit(self):
+        """Write any pending partition table changes to the image file.
+
+        This is a no-op if there are no partition() changes which have not
+        yet been written out.
+        """
+        if self._uncommitted:
+            self.disk.commit()
+            self._uncommitted = False
 
     def set_parition_type(self, partnum, typecode):
         """Set the partition type for selected partition.
 
-        Since libparted is unable to provide this functionality, we use sfdisk
-        to be able to set arbitrary type identifiers.  Please note that this
-        method needs to be only used after all partition() operations have been
-        performed.  Any disk.commit() operation resets the type GUIDs to
-        defaults.
+        Since libparted is unable to provide this functionality, we write
+        the type identifier into the partition table directly: the type byte
+        for MBR schemas, and the type GUID in both the primary and backup
+        tables for GPT schemas.  Please note that this method needs to be only
+        used after all partition() operations have been performed.  Any
+        disk.commit() operation resets the type GUIDs to defaults.
 
         """
+        self.commit()
         if isinstance(typecode, tuple):
             if self.schema is VolumeSchema.gpt:
                 typecode = typecode[1]
             else:
                 typecode = typecode[0]
-        run(['sfdisk', '--part-type', self.path,
-             str(partnum), str(typecode)])
+        if self.schema is VolumeSchema.mbr:
+            # An MBR partition type is a single byte in the partition table,
+            # so poke it in directly rather than starting up sfdisk for it.
+            offset = (MBR_TABLE_OFFSET + MBR_ENTRY_SIZE * (partnum - 1) +
+                      MBR_TYPE_OFFSET)
+            with open(self.path, 'rb+') as fp:
+                fp.seek(offset)
+                fp.write(bytes([int(typecode, 16)]))
+            return
+        # The gadget.yaml parser hands over GPT types as UUID objects, but
+        # they may also be given as strings.
+        type_guid = UUID(str(typecode)).bytes_le
+        with open(self.path, 'rb+') as fp:
+            # Update the primary table first, since its header tells us where
+            # the backup table is.
+            backup_lba = self._set_gpt_entry_type(
+                fp, GPT_HEADER_LBA, partnum, type_guid)
+            self._set_gpt_entry_type(fp, backup_lba, partnum, type_guid)
+
+    def _set_gpt_entry_type(self, fp, header_lba, partnum, type_guid):
+        """Set a partition's type GUID in one copy of the GPT.
+
+        Both CRC32s in the header are updated to match.  Returns the LBA of
+        the other copy of the header.
+        """
+        fp.seek(header_lba * self.sector_size)
+        header = bytearray(fp.read(self.sector_size))
+        (signature, revision, header_size, header_crc, current_lba,
+         alternate_lba, first_usable_lba, last_usable_lba, disk_guid,
+         entries_lba, num_entries, entry_size,
+         entries_crc) = GPT_HEADER.unpack_from(header)
+        if signature != GPT_SIGNATURE:
+            raise ValueError('No GPT header at LBA {}'.format(header_lba))
+        if not 0 < partnum <= num_entries:
+            raise ValueError('No GPT partition entry {}'.format(partnum))
+        fp.seek(entries_lba * self.sector_size)
+        entries = bytearray(fp.read(num_entries * entry_size))
+        entry_offset = (partnum - 1) * entry_size
+        entries[entry_offset:entry_offset + len(type_guid)] = type_guid
+        # The header CRC is calculated with its own field zeroed out.
+        GPT_HEADER.pack_into(
+            header, 0, signature, revision, header_size, 0, current_lba,
+            alternate_lba, first_usable_lba, last_usable_lba, disk_guid,
+            entries_lba, num_entries, entry_size, crc32(entries))
+        UINT32_LE.pack_into(
+            header, GPT_HEADER_CRC_OFFSET, crc32(header[:header_size]))
+        fp.seek(entries_lba * self.sector_size)
+        fp.write(entries)
+        fp.seek(header_lba * self.sector_size)
+        fp.write(header)
+        return alternate_lba
 
     def diagnostics(self):
         """Return diagnostics string.
@@ -153,6 +326,7 @@ class Image:
         :return: Dictionary with disk parition information
         :rtype: dict
         """
+        self.commit()
         status = run(['sfdisk', '--json', self.path])
         disk_info = load_json(status.stdout)
         # TBD:
@@ -173,16 +347,19 @@ class Image:
         :type size: int
         """
         # We do not want to allow writing past the end of the file to silently
-        # extend it, but because we open the file in + mode, a seek past the
-        # end of the file plus the write *will* silently extend it.  LBYL, but
-        # don't forget we start at zero!  And don't forget that we're writing
-        # 4 bytes so we can't seek to a position >= size + 4.
-        if os.path.getsize(self.path) - 4 < offset:
-            raise ValueError('write offset beyond end of file')
-        binary_value = pack('<I', value)
-        with open(self.path, 'rb+') as fp:
-            fp.seek(offset)
-            fp.write(binary_value)
+        # extend it, but a positioned write past the end of the file *will*
+        # silently extend it.  LBYL, but don't forget we start at zero!  And
+        # don't forget that we're writing 4 bytes so we can't write at a
+        # position >= size + 4.
+        self.commit()
+        binary_value = UINT32_LE.pack(value)
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            if os.fstat(fd).st_size - UINT32_LE.size < offset:
+                raise ValueError('write offset beyond end of file')
+            os.pwrite(fd, binary_value, offset)
+        finally:
+            os.close(fd)
 
     def sector(self, value):
         """Helper function that converts sectors to bytes for the device.
@@ -10,6 +10,7 @@ from subprocess import PIPE, run as subprocess_run
 from types import SimpleNamespace
 from ubuntu_image.assertion_builder import ModelAssertionBuilder
 from ubuntu_image.classic_builder import ClassicBuilder
+from ubuntu_image.testing.nose import NosePlugin
 from unittest.mock import patch
 
 
@@ -173,3 +174,39 @@ def envar(key, value):
             del os.environ[key]
         else:
             os.environ[key] = old_value
+
+
+@contextmanager
+def unmocked_snap():
+    # Temporarily run the real snap() helper instead of the testsuite-wide
+    # mock, for tests which mock out the underlying command themselves.
+    mocker = NosePlugin.snap_mocker
+    if mocker is None:
+        yield
+        return
+    mocker.patcher.stop()
+    try:
+        yield
+    finally:
+        mocker.patcher.start()
+
+
+def scratch_dir(needed):
+    # Where tests should put their scratch image files.  The image tests
+    # create many multi-MiB files, so prefer keeping those in memory when
+    # /dev/shm has at least `needed` bytes free.  This can be overridden
+    # with $UBUNTU_IMAGE_TEST_TMPDIR, and a $TMPDIR chosen by the developer
+    # always wins over /dev/shm.  None means to use the default temporary
+    # directory.
+    override = os.environ.get('UBUNTU_IMAGE_TEST_TMPDIR')
+    if override is not None:
+        return override
+    if 'TMPDIR' in os.environ or not os.access('/dev/shm', os.W_OK):
+        return None
+    try:
+        stats = os.statvfs('/dev/shm')
+    except OSError:
+        return None
+    if stats.f_bavail * stats.f_frsize < needed:
+        return None
+    return '/dev/shm'
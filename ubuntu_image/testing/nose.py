@@ -201,6 +201,18 @@ class NosePlugin(Plugin):
     def stopTestRun(self, event):
         self.resources.close()
 
+    def registerInSubprocess(self, event):
+        # When the test suite is sharded across processes with -N, the tests
+        # run in the worker processes, so each of those needs its own snap
+        # mocker.
+        event.pluginClasses.append(self.__class__)
+
+    def startSubprocess(self, event):
+        self.startTestRun(event)
+
+    def stopSubprocess(self, event):
+        self.stopTestRun(event)
+
     # def startTest(self, event):
     #     import sys; print('vvvvv', event.test, file=sys.stderr)
 
@@ -17,8 +17,7 @@ from ubuntu_image.helpers import DoesNotFit, MiB, run
 from ubuntu_image.parser import (
     BootLoader, FileSystemType, StructureRole, VolumeSchema)
 from ubuntu_image.testing.helpers import (
-    LogCapture, XXXModelAssertionBuilder, envar)
-from ubuntu_image.testing.nose import NosePlugin
+    LogCapture, XXXModelAssertionBuilder, envar, unmocked_snap)
 from unittest import TestCase, skipIf
 from unittest.mock import patch
 
@@ -3199,9 +3198,7 @@ class TestModelAssertionBuilder(TestCase):
             # This tests needs to run the actual snap() helper function, not
             # the testsuite-wide mock.  This is appropriate since we're
             # mocking it ourselves here.
-            if NosePlugin.snap_mocker is not None:
-                NosePlugin.snap_mocker.patcher.stop()
-                resources.callback(NosePlugin.snap_mocker.patcher.start)
+            resources.enter_context(unmocked_snap())
             workdir = resources.enter_context(TemporaryDirectory())
             unpackdir = resources.enter_context(TemporaryDirectory())
             # Fast forward a state machine to the method under test.
@@ -3250,9 +3247,7 @@ class TestModelAssertionBuilder(TestCase):
             # This tests needs to run the actual snap() helper function, not
             # the testsuite-wide mock.  This is appropriate since we're
             # mocking it ourselves here.
-            if NosePlugin.snap_mocker is not None:
-                NosePlugin.snap_mocker.patcher.stop()
-                resources.callback(NosePlugin.snap_mocker.patcher.start)
+            resources.enter_context(unmocked_snap())
             workdir = resources.enter_context(TemporaryDirectory())
             unpackdir = resources.enter_context(TemporaryDirectory())
             # Fast forward a state machine to the method under test.
@@ -3300,9 +3295,7 @@ class TestModelAssertionBuilder(TestCase):
             # This tests needs to run the actual snap() helper function, not
             # the testsuite-wide mock.  This is appropriate since we're
             # mocking it ourselves here.
-            if NosePlugin.snap_mocker is not None:
-                NosePlugin.snap_mocker.patcher.stop()
-                resources.callback(NosePlugin.snap_mocker.patcher.start)
+            resources.enter_context(unmocked_snap())
             workdir = resources.enter_context(TemporaryDirectory())
             unpackdir = resources.enter_context(TemporaryDirectory())
             # Fast forward a state machine to the method under test.
@@ -3354,9 +3347,7 @@ class TestModelAssertionBuilder(TestCase):
             # This tests needs to run the actual snap() helper function, not
             # the testsuite-wide mock.  This is appropriate since we're
             # mocking it ourselves here.
-            if NosePlugin.snap_mocker is not None:
-                NosePlugin.snap_mocker.patcher.stop()
-                resources.callback(NosePlugin.snap_mocker.patcher.start)
+            resources.enter_context(unmocked_snap())
             workdir = resources.enter_context(TemporaryDirectory())
             unpackdir = resources.enter_context(TemporaryDirectory())
             # Fast forward a state machine to the method under test.
@@ -1,17 +1,18 @@
 """Test the helpers."""
 
 import os
-import re
 import json
 import errno
+import shlex
 import logging
 
 from collections import OrderedDict
 from contextlib import ExitStack
+from glob import glob
 from pkg_resources import resource_filename
-from shutil import copytree
+from shutil import copy2, copytree
 from subprocess import DEVNULL, run as subprocess_run
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import TemporaryDirectory
 from types import SimpleNamespace
 from ubuntu_image.helpers import (
      DependencyError, GiB, MiB, PrivilegeError, as_bool, as_size,
@@ -21,7 +22,15 @@ from ubuntu_image.helpers import (
 from ubuntu_image.testing.helpers import (
      LiveBuildMocker, LogCapture, envar)
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+
+
+LOG_COMMAND_FAILED = (logging.ERROR, 'COMMAND FAILED: /bin/false')
+LOG_FAKE_STDOUT = (logging.ERROR, 'fake stdout')
+LOG_FAKE_STDERR = (logging.ERROR, 'fake stderr')
+
+FALSY_VALUES = frozenset({'no', 'False', '0', 'DISABLE', 'DiSaBlEd'})
+TRUTHY_VALUES = frozenset({'YES', 'tRUE', '1', 'eNaBlE', 'enabled'})
 
 
 class FakeProc:
@@ -50,10 +59,12 @@ def is_sparse(path):
     # be to use SEEK_DATA with an offset of 0 to find the first block of data
     # after position 0.  If there is no data, an ENXIO will get raised, at
     # least on any modern Linux kernels we care about.  See lseek(2) for
-    # details.
-    with open(path, 'r') as fp:
+    # details.  We only need a file descriptor for the lseek(), so skip
+    # the Python file object wrapping.
+    fd = os.open(path, os.O_RDONLY)
+    try:
         try:
-            os.lseek(fp.fileno(), 0, os.SEEK_DATA)
+            os.lseek(fd, 0, os.SEEK_DATA)
         except OSError as error:
             # There is no OSError subclass for ENXIO.
             if error.errno != errno.ENXIO:
@@ -61,8 +72,32 @@ def is_sparse(path):
             # The expected exception occurred, meaning, there is no data in
             # the file, so it's entirely sparse.
             return True
-    # The expected exception did not occur, so there is data in the file.
-    return False
+        # The expected exception did not occur, so there is data in the file.
+        return False
+    finally:
+        os.close(fd)
+
+
+def enter_live_build(resources, *, arch='amd64', host_arch='amd64',
+                     find_executable='/usr/bin/qemu-arm-static'):
+    # Common setup for the live_build() tests.  All the contexts are entered
+    # on the caller's ExitStack; what is returned is the LiveBuildMocker, the
+    # root directory to build in, and a base environment which the test may
+    # further modify before calling live_build().
+    tmpdir = resources.enter_context(TemporaryDirectory())
+    root_dir = os.path.join(tmpdir, 'root_dir')
+    mock = LiveBuildMocker(root_dir)
+    resources.enter_context(LogCapture())
+    resources.enter_context(patch.multiple(
+        'ubuntu_image.helpers',
+        run=mock.run,
+        get_host_arch=MagicMock(return_value=host_arch),
+        find_executable=MagicMock(return_value=find_executable)))
+    env = OrderedDict()
+    env['PROJECT'] = 'ubuntu-server'
+    env['SUITE'] = 'xenial'
+    env['ARCH'] = arch
+    return mock, root_dir, env
 
 
 class MountMocker:
@@ -96,18 +131,32 @@ class MountMocker:
             # and it's a temporary directory anyway.
             pass
         elif command.startswith('sudo cp'):
-            # Pass this command upward, but without the sudo.
-            subprocess_run(command[5:], *args, **kws)
-            # Now, because mount() called from mkfs_ext4() will cull its own
-            # temporary directory, and that tempdir is the mountpoint captured
-            # above, copy the entire contents of the mount point directory to
-            # a results tempdir that we can check below for a passing grade.
-            copytree(self.mountpoint, self.results_dir)
+            # Emulate the `sudo cp -dR --preserve=... <contents>/* <mount>`
+            # call in-process.  Because mount() called from mkfs_ext4() will
+            # cull its own temporary directory, and that tempdir is the
+            # mountpoint captured above, copy the contents straight into a
+            # results tempdir that we can check below for a passing grade.
+            *flags, source, target = shlex.split(command)[2:]
+            if ('-dR' not in flags or not source.endswith('/*')
+                    or target != self.mountpoint):
+                raise AssertionError(
+                    'Unexpected cp command: {}'.format(command))
+            # Like the shell, only copy what the glob matches, so dotfiles
+            # get left behind.
+            os.makedirs(self.results_dir, exist_ok=True)
+            for path in glob(source):
+                destination = os.path.join(
+                    self.results_dir, os.path.basename(path))
+                if os.path.isdir(path) and not os.path.islink(path):
+                    copytree(path, destination, symlinks=True)
+                else:
+                    copy2(path, destination, follow_symlinks=False)
             # We also want to somehow test if, when requested, the cp call has
             # the --preserve=ownership flag present.  There's no other nice
             # way of mocking this as everything else would require root.
-            if re.search(r'--preserve=[^ ]*ownership', command):
-                self.preserves_ownership = True
+            self.preserves_ownership = any(
+                flag.startswith('--preserve=') and 'ownership' in flag
+                for flag in flags)
         elif command.startswith('dd'):
             # dd is a safe command so we should just run it.
             subprocess_run(command, shell=True, stdout=DEVNULL, stderr=DEVNULL)
@@ -157,9 +206,9 @@ class TestHelpers(TestCase):
                       return_value=FakeProc()))
             run('/bin/false')
             self.assertEqual(log.logs, [
-                (logging.ERROR, 'COMMAND FAILED: /bin/false'),
-                (logging.ERROR, 'fake stdout'),
-                (logging.ERROR, 'fake stderr'),
+                LOG_COMMAND_FAILED,
+                LOG_FAKE_STDOUT,
+                LOG_FAKE_STDERR,
                 ])
 
     def test_run_fails_no_output(self):
@@ -169,15 +218,15 @@ class TestHelpers(TestCase):
                 patch('ubuntu_image.helpers.subprocess_run',
                       return_value=FakeProcNoOutput()))
             run('/bin/false')
-            self.assertEqual(log.logs, [
-                (logging.ERROR, 'COMMAND FAILED: /bin/false'),
-                ])
+            self.assertEqual(log.logs, [LOG_COMMAND_FAILED])
 
     def test_as_bool(self):
-        for value in {'no', 'False', '0', 'DISABLE', 'DiSaBlEd'}:
-            self.assertFalse(as_bool(value), value)
-        for value in {'YES', 'tRUE', '1', 'eNaBlE', 'enabled'}:
-            self.assertTrue(as_bool(value), value)
+        for value in FALSY_VALUES:
+            with self.subTest(value=value):
+                self.assertFalse(as_bool(value))
+        for value in TRUTHY_VALUES:
+            with self.subTest(value=value):
+                self.assertTrue(as_bool(value))
         self.assertRaises(ValueError, as_bool, 'anything else')
 
     def test_get_host_arch(self):
@@ -311,10 +360,10 @@ class TestHelpers(TestCase):
                 self.assertEqual(len(mock.call_args_list), 1)
                 customize_path = os.path.join(tmpworkdir, 'customization')
                 self.assertTrue(os.path.exists(customize_path))
-                with open(customize_path) as fp:
-                    self.assertDictEqual(
-                        json.load(fp),
-                        result)
+                # The file is tiny, so skip the text decoding layer and hand
+                # the raw bytes straight to the JSON decoder.
+                with open(customize_path, 'rb') as fp:
+                    self.assertEqual(json.loads(fp.read()), result)
                 args, kws = mock.call_args_list[0]
             self.assertEqual(
                 args[0],
@@ -324,19 +373,7 @@ class TestHelpers(TestCase):
 
     def test_live_build(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'amd64'
+            mock, root_dir, env = enter_live_build(resources)
             live_build(root_dir, env)
             self.assertEqual(len(mock.call_args_list), 3)
             self.assertEqual(
@@ -352,19 +389,8 @@ class TestHelpers(TestCase):
 
     def test_live_build_with_full_args(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            env = OrderedDict()
+            mock, root_dir, env = enter_live_build(resources)
             env['PROJECT'] = 'ubuntu-cpc'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'amd64'
             env['SUBPROJECT'] = 'live'
             env['SUBARCH'] = 'ubuntu-cpc'
             env['PROPOSED'] = 'true'
@@ -389,25 +415,13 @@ class TestHelpers(TestCase):
 
     def test_live_build_env_livecd(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            auto_dir = os.path.join(tmpdir, 'auto')
+            mock, root_dir, env = enter_live_build(resources)
+            auto_dir = os.path.join(os.path.dirname(root_dir), 'auto')
             os.mkdir(auto_dir)
             with open(os.path.join(auto_dir, 'config'), 'w') as fp:
                 fp.write('DUMMY')
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
             resources.enter_context(
                 envar('UBUNTU_IMAGE_LIVECD_ROOTFS_AUTO_PATH', auto_dir))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'amd64'
             live_build(root_dir, env)
             # Make sure that we had no dpkg -L call made.
             self.assertEqual(len(mock.call_args_list), 2)
@@ -428,22 +442,9 @@ class TestHelpers(TestCase):
 
     def test_live_build_cross_build(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.find_executable',
-                      return_value='/usr/bin/qemu-arm-static-fake'))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'armhf'
+            mock, root_dir, env = enter_live_build(
+                resources, arch='armhf',
+                find_executable='/usr/bin/qemu-arm-static-fake')
             live_build(root_dir, env)
             self.assertEqual(len(mock.call_args_list), 3)
             self.assertEqual(
@@ -462,25 +463,10 @@ class TestHelpers(TestCase):
 
     def test_live_build_cross_build_env_path(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.find_executable',
-                      return_value='/usr/bin/qemu-arm-static'))
+            mock, root_dir, env = enter_live_build(resources, arch='armhf')
             resources.enter_context(
                 envar('UBUNTU_IMAGE_QEMU_USER_STATIC_PATH',
                       '/opt/qemu-arm-static'))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'armhf'
             live_build(root_dir, env)
             self.assertEqual(len(mock.call_args_list), 3)
             self.assertEqual(
@@ -499,22 +485,8 @@ class TestHelpers(TestCase):
 
     def test_live_build_cross_build_no_static(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.find_executable',
-                      return_value=None))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'armhf'
+            mock, root_dir, env = enter_live_build(
+                resources, arch='armhf', find_executable=None)
             with self.assertRaises(DependencyError) as cm:
                 live_build(root_dir, env)
             self.assertEqual(len(mock.call_args_list), 1)
@@ -523,22 +495,7 @@ class TestHelpers(TestCase):
 
     def test_live_build_no_cross_build(self):
         with ExitStack() as resources:
-            tmpdir = resources.enter_context(TemporaryDirectory())
-            root_dir = os.path.join(tmpdir, 'root_dir')
-            mock = LiveBuildMocker(root_dir)
-            resources.enter_context(LogCapture())
-            resources.enter_context(
-                patch('ubuntu_image.helpers.run', mock.run))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.get_host_arch',
-                      return_value='amd64'))
-            resources.enter_context(
-                patch('ubuntu_image.helpers.find_executable',
-                      return_value='/usr/bin/qemu-arm-static'))
-            env = OrderedDict()
-            env['PROJECT'] = 'ubuntu-server'
-            env['SUITE'] = 'xenial'
-            env['ARCH'] = 'armhf'
+            mock, root_dir, env = enter_live_build(resources, arch='armhf')
             live_build(root_dir, env, enable_cross_build=False)
             # Make sure that if we explicity disable cross-building, no
             # cross-build arguments are passed to lb config
@@ -562,15 +519,28 @@ class TestHelpers(TestCase):
                 fp.write(b'01234')
             with open(os.path.join(contents_dir, 'b.dat'), 'wb') as fp:
                 fp.write(b'56789')
-            # And a fake image file.
-            img_file = resources.enter_context(NamedTemporaryFile())
+            os.mkdir(os.path.join(contents_dir, 'c'))
+            with open(os.path.join(contents_dir, 'c', 'd.dat'), 'wb') as fp:
+                fp.write(b'abcde')
+            # The <contents>/* glob doesn't match dotfiles, so this one is
+            # never copied.
+            with open(os.path.join(contents_dir, '.hidden'), 'wb') as fp:
+                fp.write(b'fghij')
+            # And a fake image file.  The mocked commands never touch it, so
+            # it doesn't even need to exist.
+            img_file = os.path.join(tmpdir, 'img')
             mkfs_ext4(img_file, contents_dir, cmd)
-            # Two files were put in the "mountpoint" directory, but because of
+            # The files were put in the "mountpoint" directory, but because of
             # above, we have to check them in the results copy.
             with open(os.path.join(mock.results_dir, 'a.dat'), 'rb') as fp:
                 self.assertEqual(fp.read(), b'01234')
             with open(os.path.join(mock.results_dir, 'b.dat'), 'rb') as fp:
                 self.assertEqual(fp.read(), b'56789')
+            path = os.path.join(mock.results_dir, 'c', 'd.dat')
+            with open(path, 'rb') as fp:
+                self.assertEqual(fp.read(), b'abcde')
+            self.assertFalse(
+                os.path.exists(os.path.join(mock.results_dir, '.hidden')))
 
     def test_mkfs_ext4_snap(self):
         self.aux_test_mkfs_ext4('snap')
@@ -587,8 +557,9 @@ class TestHelpers(TestCase):
                 patch('ubuntu_image.helpers.run', mock.run))
             # Create a temporary directory, but this time without contents.
             contents_dir = resources.enter_context(TemporaryDirectory())
-            # And a fake image file.
-            img_file = resources.enter_context(NamedTemporaryFile())
+            # And a fake image file.  The mocked commands never touch it, so
+            # it doesn't even need to exist.
+            img_file = os.path.join(tmpdir, 'img')
             mkfs_ext4(img_file, contents_dir, 'snap')
             # Because there were no contents, the `sudo cp` was never called,
             # the mock's shutil.copytree() was also never called, therefore
@@ -606,8 +577,9 @@ class TestHelpers(TestCase):
             contents_dir = resources.enter_context(TemporaryDirectory())
             with open(os.path.join(contents_dir, 'a.dat'), 'wb') as fp:
                 fp.write(b'01234')
-            # And a fake image file.
-            img_file = resources.enter_context(NamedTemporaryFile())
+            # And a fake image file.  The mocked commands never touch it, so
+            # it doesn't even need to exist.
+            img_file = os.path.join(tmpdir, 'img')
             mkfs_ext4(img_file, contents_dir, 'snap', preserve_ownership=True)
             with open(os.path.join(mock.results_dir, 'a.dat'), 'rb') as fp:
                 self.assertEqual(fp.read(), b'01234')
@@ -643,8 +615,8 @@ class TestHelpers(TestCase):
             swapfile = os.path.join(results_dir, 'swapfile')
             run('dd if=/dev/zero of={} bs=10M count=1'.format(swapfile),
                 stdout=DEVNULL, stderr=DEVNULL)
-            # Image file.
-            img_file = resources.enter_context(NamedTemporaryFile())
+            # Image file.  The mocked commands never touch it.
+            img_file = os.path.join(tmpdir, 'img')
             mock = MountMocker(results_dir, results_dir)
             resources.enter_context(
                 patch('ubuntu_image.helpers.run', mock.run))
@@ -659,8 +631,8 @@ class TestHelpers(TestCase):
             os.makedirs(results_dir)
             # No swapfile, just some file.
             open(os.path.join(results_dir, 'foobar'), 'w')
-            # Image file.
-            img_file = resources.enter_context(NamedTemporaryFile())
+            # Image file.  The mocked commands never touch it.
+            img_file = os.path.join(tmpdir, 'img')
             mock = MountMocker(results_dir, results_dir)
             resources.enter_context(
                 patch('ubuntu_image.helpers.run', mock.run))
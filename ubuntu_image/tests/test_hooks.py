@@ -3,10 +3,38 @@
 import os
 
 from contextlib import ExitStack
+from subprocess import CompletedProcess
 from tempfile import TemporaryDirectory
 from textwrap import dedent
 from ubuntu_image.hooks import HookError, HookManager
 from unittest import TestCase
+from unittest.mock import patch
+
+
+def recording_run(calls):
+    # Return a stand-in for the run() helper which records the hook scripts
+    # it is asked to run, so that the dispatch order can be checked without
+    # forking a shell for each one.
+    def run(command, *, check=True, **args):
+        calls.append(command)
+        return CompletedProcess(command, 0, '', '')
+    return run
+
+
+def write_exec(path, script):
+    # Write out an executable hook script.  Passing the mode to os.open()
+    # saves a separate chmod, and there's no need for buffered file objects
+    # just to write a few bytes.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o744)
+    try:
+        os.write(fd, script.encode())
+    finally:
+        os.close(fd)
+
+
+def touch(path):
+    with open(path, 'wb'):
+        pass
 
 
 class TestHooks(TestCase):
@@ -22,12 +50,10 @@ class TestHooks(TestCase):
             hookfile = os.path.join(hooksdir, 'test-hook')
             resultfile = os.path.join(hooksdir, 'result')
             env = {'UBUNTU_IMAGE_TEST_ENV': 'true'}
-            with open(hookfile, 'w') as fp:
-                fp.write("""\
+            write_exec(hookfile, """\
 #!/bin/sh
 echo -n "$UBUNTU_IMAGE_TEST_ENV" >>{}
 """.format(resultfile))
-            os.chmod(hookfile, 0o744)
             manager = HookManager([hooksdir])
             manager.fire('test-hook', env)
             # Check if the script ran once as expected.
@@ -42,28 +68,18 @@ echo -n "$UBUNTU_IMAGE_TEST_ENV" >>{}
             hookfile1 = os.path.join(hookdir, 'dir-test-01')
             hookfile2 = os.path.join(hookdir, 'dir-test-02')
             hookfile3 = os.path.join(hooksdir, 'test-hook')
-            resultfile = os.path.join(hooksdir, 'result')
             os.mkdir(hookdir)
-
-            def create_hook(path):
-                with open(path, 'w') as fp:
-                    fp.write(dedent("""\
-                                    #!/bin/sh
-                                    echo "{}" >>{}
-                                    """.format(path, resultfile)))
-                os.chmod(path, 0o744)
-            create_hook(hookfile1)
-            create_hook(hookfile2)
-            create_hook(hookfile3)
+            touch(hookfile1)
+            touch(hookfile2)
+            touch(hookfile3)
+            calls = []
+            resources.enter_context(
+                patch('ubuntu_image.hooks.run', recording_run(calls)))
             manager = HookManager([hooksdir])
             manager.fire('test-hook')
             # Check if all the scripts for the hook were run and in the right
             # order.
-            self.assertTrue(os.path.exists(resultfile))
-            with open(resultfile, 'r') as fp:
-                lines = fp.read().splitlines()
-                self.assertListEqual(
-                    lines, [hookfile1, hookfile2, hookfile3])
+            self.assertListEqual(calls, [hookfile1, hookfile2, hookfile3])
 
     def test_hook_multiple_directories(self):
         with ExitStack() as resources:
@@ -72,40 +88,27 @@ echo -n "$UBUNTU_IMAGE_TEST_ENV" >>{}
             hookdir = os.path.join(hooksdir1, 'test-hook.d')
             hookfile1 = os.path.join(hookdir, 'dir-test-01')
             hookfile2 = os.path.join(hooksdir2, 'test-hook')
-            # We write the results to one file to check if order is proper.
-            resultfile = os.path.join(hooksdir1, 'result')
             os.mkdir(hookdir)
-
-            def create_hook(path):
-                with open(path, 'w') as fp:
-                    fp.write(dedent("""\
-                                    #!/bin/sh
-                                    echo "{}" >>{}
-                                    """.format(path, resultfile)))
-                os.chmod(path, 0o744)
-            create_hook(hookfile1)
-            create_hook(hookfile2)
+            touch(hookfile1)
+            touch(hookfile2)
+            calls = []
+            resources.enter_context(
+                patch('ubuntu_image.hooks.run', recording_run(calls)))
             manager = HookManager([hooksdir1, hooksdir2])
             manager.fire('test-hook')
             # Check if all the scripts for the hook were run and in the right
             # order.
-            self.assertTrue(os.path.exists(resultfile))
-            with open(resultfile, 'r') as fp:
-                lines = fp.read().splitlines()
-                self.assertListEqual(
-                    lines, [hookfile1, hookfile2])
+            self.assertListEqual(calls, [hookfile1, hookfile2])
 
     def test_hook_error(self):
         with ExitStack() as resources:
             hooksdir = resources.enter_context(TemporaryDirectory())
             hookfile = os.path.join(hooksdir, 'test-hook')
-            with open(hookfile, 'w') as fp:
-                fp.write(dedent("""\
-                                #!/bin/sh
-                                echo -n "error" 1>&2
-                                exit 1
-                                """))
-            os.chmod(hookfile, 0o744)
+            write_exec(hookfile, dedent("""\
+                #!/bin/sh
+                echo -n "error" 1>&2
+                exit 1
+                """))
             manager = HookManager([hooksdir])
             # Check if hook script failures are properly reported
             with self.assertRaises(HookError) as cm:
@@ -114,3 +117,19 @@ echo -n "$UBUNTU_IMAGE_TEST_ENV" >>{}
             self.assertEqual(cm.exception.hook_path, hookfile)
             self.assertEqual(cm.exception.hook_retcode, 1)
             self.assertEqual(cm.exception.hook_stderr, 'error')
+
+    def test_hook_error_large_stderr(self):
+        # A failing hook may produce much more error output than fits in a
+        # pipe buffer.  All of it must still be captured.
+        with ExitStack() as resources:
+            hooksdir = resources.enter_context(TemporaryDirectory())
+            hookfile = os.path.join(hooksdir, 'test-hook')
+            write_exec(hookfile, dedent("""\
+                #!/bin/sh
+                head -c 262144 /dev/zero | tr '\\0' x 1>&2
+                exit 1
+                """))
+            manager = HookManager([hooksdir])
+            with self.assertRaises(HookError) as cm:
+                manager.fire('test-hook')
+            self.assertEqual(cm.exception.hook_stderr, 'x' * 262144)
@@ -4,10 +4,11 @@ import os
 import logging
 import argparse
 
-from contextlib import ExitStack, contextmanager
+from contextlib import (
+    ExitStack, contextmanager, redirect_stderr, redirect_stdout)
 from io import StringIO
 from mmap import mmap
-from pickle import load
+from pickle import loads
 from pkg_resources import resource_filename
 from subprocess import CalledProcessError
 from tempfile import TemporaryDirectory
@@ -19,10 +20,25 @@ from ubuntu_image.testing.helpers import (
     CallLBLeaveATraceClassicBuilder, CrashingModelAssertionBuilder,
     DoNothingBuilder, EarlyExitLeaveATraceAssertionBuilder,
     EarlyExitLeaveATraceClassicBuilder, EarlyExitModelAssertionBuilder,
-    LogCapture, XXXModelAssertionBuilder, envar)
-from ubuntu_image.testing.nose import NosePlugin
+    LogCapture, XXXModelAssertionBuilder, envar, unmocked_snap)
 from unittest import TestCase, skipIf
-from unittest.mock import call, patch
+from unittest.mock import DEFAULT, call, patch
+
+
+# Test data paths, looked up once rather than for every test since
+# pkg_resources has to go through the package metadata each time.
+MODEL_ASSERTION = resource_filename(
+    'ubuntu_image.tests.data', 'model.assertion')
+CLASSIC_GADGET_TREE = resource_filename(
+    'ubuntu_image.tests.data', 'gadget_tree')
+# A minimal UC20 model assertion, written out as-is by the tests.
+UC20_MODEL_ASSERTION = b"""\
+type: model
+series: 16
+base: core20
+grade: dangerous
+(...)
+"""
 
 
 # For forcing a test failure.
@@ -40,10 +56,49 @@ def chdir(new_dir):
         os.chdir(here)
 
 
-class BadGadgetModelAssertionBuilder(XXXModelAssertionBuilder):
+def use_builder(builder):
+    # Make main() run the given builder class for snap images.
+    return patch('ubuntu_image.__main__.ModelAssertionBuilder', builder)
+
+
+def use_classic_builder(builder):
+    # Make main() run the given builder class for classic images.
+    return patch('ubuntu_image.__main__.ClassicBuilder', builder)
+
+
+_null_handler = logging.NullHandler()
+
+
+def setUpModule():
+    # Many of these tests drive main() down paths which log warnings and
+    # errors.  Nobody reads those, so hand them to a do-nothing handler
+    # rather than having them formatted onto stderr.  The level is left
+    # alone so that LogCapture still sees every record.
+    logger = logging.getLogger('ubuntu-image')
+    logger.addHandler(_null_handler)
+    logger.propagate = False
+
+
+def tearDownModule():
+    logger = logging.getLogger('ubuntu-image')
+    logger.removeHandler(_null_handler)
+    logger.propagate = True
+
+
+class BadGadgetModelAssertionBuilder(DoNothingBuilder):
     gadget_yaml = 'bad-gadget.yaml'
 
 
+class MultiImageModelAssertionBuilder(DoNothingBuilder):
+    gadget_yaml = 'gadget-multi.yaml'
+
+
+class MBRGadgetModelAssertionBuilder(DoNothingBuilder):
+    # A gadget with an mbr structure, like the one in the real pc gadget
+    # snap.
+    gadget_yaml = 'gadget_tree/meta/gadget.yaml'
+
+
 class TestGetModifiedArgs(TestCase):
     def test_image_with_help(self):
         parser = argparse.ArgumentParser(add_help=False)
@@ -55,7 +110,7 @@ class TestGetModifiedArgs(TestCase):
 
     def test_image_without_subcommand(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             parser = argparse.ArgumentParser(add_help=False)
             # create one subcommand, "snap"
             subparser = parser.add_subparsers(dest='cmd')
@@ -81,7 +136,7 @@ class TestGetModifiedArgs(TestCase):
 
     def test_image_with_multiple_subcommand(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             parser = argparse.ArgumentParser(add_help=False)
             # create two subcommands, "snap" and "classic"
             subparser = parser.add_subparsers(dest='cmd')
@@ -96,42 +151,35 @@ class TestGetModifiedArgs(TestCase):
 
 
 class TestParseArgs(TestCase):
-    def test_image_size_option_bytes(self):
-        args = parseargs(['snap', '--image-size', '45', 'model.assertion'])
-        self.assertEqual(args.image_size, 45)
-        self.assertEqual(args.given_image_size, '45')
+    def test_image_size_option(self):
+        for size, expected in (('45', 45), ('45G', GiB(45)), ('45M', MiB(45))):
+            with self.subTest(size=size):
+                args = parseargs(
+                    ['snap', '--image-size', size, 'model.assertion'])
+                self.assertEqual(args.image_size, expected)
+                self.assertEqual(args.given_image_size, size)
 
     def test_image_size_option_bytes_without_subcommand(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             args = parseargs(['--image-size', '45', 'model.assertion'])
             self.assertEqual(args.image_size, 45)
             self.assertEqual(args.given_image_size, '45')
 
-    def test_image_size_option_suffixes(self):
-        args = parseargs(['snap', '--image-size', '45G', 'model.assertion'])
-        self.assertEqual(args.image_size, GiB(45))
-        self.assertEqual(args.given_image_size, '45G')
-        args = parseargs(['snap', '--image-size', '45M', 'model.assertion'])
-        self.assertEqual(args.image_size, MiB(45))
-        self.assertEqual(args.given_image_size, '45M')
-
     def test_image_size_option_invalid(self):
         # These errors will output to stderr, but that just clouds the test
         # output, so suppress it.
-        with patch('argparse._sys.stderr'):
-            self.assertRaises(SystemExit,
-                              parseargs,
-                              ['snap', '--image-size', '45Q',
-                               'model.assertion'])
-            self.assertRaises(SystemExit,
-                              parseargs,
-                              ['snap', '--image-size', 'BIG',
-                               'model.assertion'])
+        with redirect_stderr(StringIO()):
+            for size in ('45Q', 'BIG'):
+                with self.subTest(size=size):
+                    self.assertRaises(SystemExit,
+                                      parseargs,
+                                      ['snap', '--image-size', size,
+                                       'model.assertion'])
 
     def test_output_dir_mutually_exclusive_with_output(self):
         # You can't use -O/--output-dir and -o/--output at the same time.
-        with patch('argparse._sys.stderr'):
+        with redirect_stderr(StringIO()):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['-o', '/tmp/disk.img', '-O', '/tmp'])
@@ -139,7 +187,7 @@ class TestParseArgs(TestCase):
     def test_output_is_deprecated(self):
         # -o/--output is deprecated.
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             parseargs(['-o', '/tmp/disk.img', 'model.assertion'])
         lines = stderr.getvalue().splitlines()
         self.assertTrue(
@@ -160,7 +208,7 @@ class TestParseArgs(TestCase):
     def test_extra_snaps_is_deprecated(self):
         # --extra-snaps is deprecated.
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             parseargs(['snap', '--extra-snaps', 'foo', '--extra-snaps', 'bar',
                        'model.assertion'])
         lines = stderr.getvalue().splitlines()
@@ -178,14 +226,14 @@ class TestParseArgs(TestCase):
             })
 
     def test_multivolume_no_colon(self):
-        with patch('argparse._sys.stderr'):
+        with redirect_stderr(StringIO()):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['snap', '-i', '0:2G,4G,1:8G',
                                'model.assertion'])
 
     def test_multivolume_bad_size(self):
-        with patch('argparse._sys.stderr'):
+        with redirect_stderr(StringIO()):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['snap', '-i', '0:2G,1:4BIG,2:8G',
@@ -205,7 +253,7 @@ class TestParseArgs(TestCase):
 
     def test_classic_gadget_tree_required(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['classic'])
@@ -214,7 +262,7 @@ class TestParseArgs(TestCase):
 
     def test_classic_project_or_filesystem_required(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['classic', 'tree_url'])
@@ -223,7 +271,7 @@ class TestParseArgs(TestCase):
 
     def test_classic_project_and_filesystem_exclusive(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['classic', 'tree_url', '--project',
@@ -233,7 +281,7 @@ class TestParseArgs(TestCase):
 
     def test_classic_resume_gadget_tree(self):
         stderr = StringIO()
-        with patch('sys.stderr', stderr):
+        with redirect_stderr(stderr):
             self.assertRaises(SystemExit,
                               parseargs,
                               ['classic', '--resume', 'tree_url'])
@@ -243,25 +291,36 @@ class TestParseArgs(TestCase):
     def test_uc20_normal_args_still_ok(self):
         with TemporaryDirectory() as tmpdir:
             model_path = os.path.join(tmpdir, 'model.assertion')
-            with open(model_path, 'w') as fd:
-                fd.write('type: model\nseries: 16\nbase: core20\n'
-                         'grade: dangerous\n(...)\n')
-                parseargs(['snap', model_path])
+            with open(model_path, 'wb') as fp:
+                fp.write(UC20_MODEL_ASSERTION)
+            parseargs(['snap', model_path])
 
 
 class TestMain(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The output capturing is the same for every test, so only patch it
+        # in once for the whole class.
+        cls._class_resources = ExitStack()
+        # Capture builtin print() output.
+        cls._stdout = StringIO()
+        cls._stderr = StringIO()
+        cls._class_resources.enter_context(redirect_stdout(cls._stdout))
+        # Capture stderr since this is where argparse will spew to.
+        cls._class_resources.enter_context(redirect_stderr(cls._stderr))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._class_resources.close()
+
     def setUp(self):
         super().setUp()
         self._resources = ExitStack()
         self.addCleanup(self._resources.close)
-        # Capture builtin print() output.
-        self._stdout = StringIO()
-        self._stderr = StringIO()
-        self._resources.enter_context(
-            patch('argparse._sys.stdout', self._stdout))
-        # Capture stderr since this is where argparse will spew to.
-        self._resources.enter_context(
-            patch('argparse._sys.stderr', self._stderr))
+        # Each test starts out with nothing captured.
+        for stream in (self._stdout, self._stderr):
+            stream.seek(0)
+            stream.truncate()
 
     def test_help(self):
         with self.assertRaises(SystemExit) as cm:
@@ -277,11 +336,11 @@ class TestMain(TestCase):
         with ExitStack() as resources:
             mock = resources.enter_context(
                 patch('ubuntu_image.__main__.logging.basicConfig'))
-            resources.enter_context(patch(
-                'ubuntu_image.__main__.ModelAssertionBuilder',
-                EarlyExitModelAssertionBuilder))
             # Prevent actual main() from running.
-            resources.enter_context(patch('ubuntu_image.__main__.main'))
+            resources.enter_context(patch.multiple(
+                'ubuntu_image.__main__',
+                ModelAssertionBuilder=EarlyExitModelAssertionBuilder,
+                main=DEFAULT))
             code = main(('--debug', 'model.assertion'))
         self.assertEqual(code, 0)
         mock.assert_called_once_with(level=logging.DEBUG)
@@ -290,20 +349,18 @@ class TestMain(TestCase):
         with ExitStack() as resources:
             mock = resources.enter_context(
                 patch('ubuntu_image.__main__.logging.basicConfig'))
-            resources.enter_context(patch(
-                'ubuntu_image.__main__.ModelAssertionBuilder',
-                EarlyExitModelAssertionBuilder))
             # Prevent actual main() from running.
-            resources.enter_context(patch('ubuntu_image.__main__.main'))
+            resources.enter_context(patch.multiple(
+                'ubuntu_image.__main__',
+                ModelAssertionBuilder=EarlyExitModelAssertionBuilder,
+                main=DEFAULT))
             code = main(('model.assertion',))
         self.assertEqual(code, 0)
         mock.assert_not_called()
 
     def test_state_machine_exception(self):
         with ExitStack() as resources:
-            resources.enter_context(patch(
-                'ubuntu_image.__main__.ModelAssertionBuilder',
-                CrashingModelAssertionBuilder))
+            resources.enter_context(use_builder(CrashingModelAssertionBuilder))
             mock = resources.enter_context(patch(
                 'ubuntu_image.__main__._logger.exception'))
             code = main(('model.assertion',))
@@ -317,9 +374,7 @@ class TestMain(TestCase):
         # This tests needs to run the actual snap() helper function, not
         # the testsuite-wide mock.  This is appropriate since we're
         # mocking it ourselves here.
-        if NosePlugin.snap_mocker is not None:
-            NosePlugin.snap_mocker.patcher.stop()
-            self._resources.callback(NosePlugin.snap_mocker.patcher.start)
+        self._resources.enter_context(unmocked_snap())
         self._resources.enter_context(patch(
             'ubuntu_image.helpers.subprocess_run',
             return_value=SimpleNamespace(
@@ -329,9 +384,7 @@ class TestMain(TestCase):
                 check_returncode=check_returncode,
                 )))
         self._resources.enter_context(LogCapture())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            XXXModelAssertionBuilder))
+        self._resources.enter_context(use_builder(XXXModelAssertionBuilder))
         workdir = self._resources.enter_context(TemporaryDirectory())
         imgfile = os.path.join(workdir, 'my-disk.img')
         code = main(('--until', 'prepare_filesystems',
@@ -379,30 +432,38 @@ class TestMain(TestCase):
 
 
 class TestMainWithGadget(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The output capturing and logging patches are the same for every
+        # test, so only patch them in once for the whole class.
+        cls._class_resources = ExitStack()
+        # Capture builtin print() output.
+        cls._stdout = StringIO()
+        cls._stderr = StringIO()
+        cls._class_resources.enter_context(redirect_stdout(cls._stdout))
+        # Capture stderr since this is where argparse will spew to.
+        cls._class_resources.enter_context(redirect_stderr(cls._stderr))
+        cls._class_resources.enter_context(
+            patch('ubuntu_image.__main__.logging.basicConfig'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._class_resources.close()
+
     def setUp(self):
         super().setUp()
         self._resources = ExitStack()
         self.addCleanup(self._resources.close)
-        # Capture builtin print() output.
-        self._stdout = StringIO()
-        self._stderr = StringIO()
-        self._resources.enter_context(
-            patch('argparse._sys.stdout', self._stdout))
-        # Capture stderr since this is where argparse will spew to.
-        self._resources.enter_context(
-            patch('argparse._sys.stderr', self._stderr))
+        # Each test starts out with nothing captured.
+        for stream in (self._stdout, self._stderr):
+            stream.seek(0)
+            stream.truncate()
         # Set up a few other useful things for these tests.
-        self._resources.enter_context(
-            patch('ubuntu_image.__main__.logging.basicConfig'))
-        self.model_assertion = resource_filename(
-            'ubuntu_image.tests.data', 'model.assertion')
-        self.classic_gadget_tree = resource_filename(
-            'ubuntu_image.tests.data', 'gadget_tree')
+        self.model_assertion = MODEL_ASSERTION
+        self.classic_gadget_tree = CLASSIC_GADGET_TREE
 
     def test_output_without_subcommand(self):
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         tmpdir = self._resources.enter_context(TemporaryDirectory())
         imgfile = os.path.join(tmpdir, 'my-disk.img')
         self.assertFalse(os.path.exists(imgfile))
@@ -410,9 +471,7 @@ class TestMainWithGadget(TestCase):
         self.assertTrue(os.path.exists(imgfile))
 
     def test_output(self):
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         tmpdir = self._resources.enter_context(TemporaryDirectory())
         imgfile = os.path.join(tmpdir, 'my-disk.img')
         self.assertFalse(os.path.exists(imgfile))
@@ -420,20 +479,15 @@ class TestMainWithGadget(TestCase):
         self.assertTrue(os.path.exists(imgfile))
 
     def test_output_directory(self):
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         tmpdir = self._resources.enter_context(TemporaryDirectory())
         outputdir = os.path.join(tmpdir, 'images')
         main(('snap', '--output-dir', outputdir, self.model_assertion))
         self.assertTrue(os.path.exists(os.path.join(outputdir, 'pc.img')))
 
     def test_output_directory_multiple_images(self):
-        class Builder(DoNothingBuilder):
-            gadget_yaml = 'gadget-multi.yaml'
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            Builder))
+        self._resources.enter_context(
+            use_builder(MultiImageModelAssertionBuilder))
         # Quiet the test suite.
         self._resources.enter_context(patch(
             'ubuntu_image.parser._logger.warning'))
@@ -445,11 +499,8 @@ class TestMainWithGadget(TestCase):
             self.assertTrue(os.path.exists(image_path))
 
     def test_output_directory_multiple_images_image_file_list(self):
-        class Builder(DoNothingBuilder):
-            gadget_yaml = 'gadget-multi.yaml'
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            Builder))
+        self._resources.enter_context(
+            use_builder(MultiImageModelAssertionBuilder))
         # Quiet the test suite.
         self._resources.enter_context(patch(
             'ubuntu_image.parser._logger.warning'))
@@ -468,9 +519,7 @@ class TestMainWithGadget(TestCase):
             )
 
     def test_output_image_file_list(self):
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         # Quiet the test suite.
         self._resources.enter_context(patch(
             'ubuntu_image.parser._logger.warning'))
@@ -488,15 +537,17 @@ class TestMainWithGadget(TestCase):
         # For reference see:
         # http://snapcraft.io/docs/reference/env
         self._resources.enter_context(envar('SNAP_NAME', 'crack-pop'))
-        self._resources.enter_context(chdir('/tmp'))
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
-        code = main(('snap', '--output-dir', '/tmp/images',
+        # Use a directory of our own under /tmp, so that parallel test runs
+        # don't share the output directory and nothing is left behind.
+        tmpdir = self._resources.enter_context(TemporaryDirectory(dir='/tmp'))
+        self._resources.enter_context(chdir(tmpdir))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
+        outputdir = os.path.join(tmpdir, 'images')
+        code = main(('snap', '--output-dir', outputdir,
                      '--extra-snaps', '/tmp/extra.snap',
                      '/tmp/model.assertion'))
         self.assertEqual(code, 0)
-        self.assertTrue(os.path.exists('/tmp/images/pc.img'))
+        self.assertTrue(os.path.exists(os.path.join(outputdir, 'pc.img')))
 
     def test_resume_and_model_assertion(self):
         with self.assertRaises(SystemExit) as cm:
@@ -533,12 +584,8 @@ class TestMainWithGadget(TestCase):
             main(('classic', '--until', 'whatever'))
         self.assertEqual(cm.exception.code, 2)
 
-    @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
-            'Cannot run this test without network access')
     def test_save_resume(self):
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            XXXModelAssertionBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         workdir = self._resources.enter_context(TemporaryDirectory())
         imgfile = os.path.join(workdir, 'my-disk.img')
         main(('--until', 'prepare_filesystems',
@@ -552,42 +599,52 @@ class TestMainWithGadget(TestCase):
         main(('snap', '--resume', '--workdir', workdir))
         self.assertTrue(os.path.exists(imgfile))
 
-    def test_until(self):
+    @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
+            'Cannot run this test without network access')
+    def test_save_resume_end_to_end(self):
+        # Like above, but the state saved after a real prepare_image and
+        # populate run has to survive --until and --resume too.
+        self._resources.enter_context(use_builder(XXXModelAssertionBuilder))
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
-        main(('snap', '--until', 'populate_rootfs_contents',
+        imgfile = os.path.join(workdir, 'my-disk.img')
+        main(('--until', 'prepare_filesystems',
               '--channel', 'edge',
               '--workdir', workdir,
+              '--output', imgfile,
               self.model_assertion))
-        # The pickle file will tell us how far the state machine got.
-        with open(os.path.join(workdir, '.ubuntu-image.pck'), 'rb') as fp:
-            pickle_state = load(fp).__getstate__()
-        # This is the *next* state to execute.
-        self.assertEqual(pickle_state['state'], ['populate_rootfs_contents'])
+        self.assertTrue(os.path.exists(os.path.join(
+            workdir, '.ubuntu-image.pck')))
+        self.assertFalse(os.path.exists(imgfile))
+        main(('snap', '--resume', '--workdir', workdir))
+        self.assertTrue(os.path.exists(imgfile))
 
-    def test_thru(self):
-        workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
-        main(('snap', '--thru', 'populate_rootfs_contents',
-              '--workdir', workdir,
-              '--channel', 'edge',
-              self.model_assertion))
-        # The pickle file will tell us how far the state machine got.
-        with open(os.path.join(workdir, '.ubuntu-image.pck'), 'rb') as fp:
-            pickle_state = load(fp).__getstate__()
-        # This is the *next* state to execute.
-        self.assertEqual(
-            pickle_state['state'], ['populate_rootfs_contents_hooks'])
+    def test_until_and_thru(self):
+        self._resources.enter_context(use_builder(DoNothingBuilder))
+        # Stopping before or after a state leaves a different *next* state
+        # for the state machine to execute.
+        cases = (
+            ('--until', ['populate_rootfs_contents']),
+            ('--thru', ['populate_rootfs_contents_hooks']),
+            )
+        step = 'populate_rootfs_contents'
+        for option, next_state in cases:
+            with self.subTest(step=step, option=option):
+                with TemporaryDirectory() as workdir:
+                    main(('snap', option, step,
+                          '--channel', 'edge',
+                          '--workdir', workdir,
+                          self.model_assertion))
+                    # The pickle file will tell us how far the state machine
+                    # got.
+                    path = os.path.join(workdir, '.ubuntu-image.pck')
+                    with open(path, 'rb') as fp:
+                        pickle_state = loads(fp.read()).__getstate__()
+                    self.assertEqual(pickle_state['state'], next_state)
 
     def test_resume_loads_pickle_snap(self):
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            EarlyExitLeaveATraceAssertionBuilder))
+        self._resources.enter_context(
+            use_builder(EarlyExitLeaveATraceAssertionBuilder))
         main(('snap', '--until', 'prepare_image',
               '--workdir', workdir,
               self.model_assertion))
@@ -597,9 +654,8 @@ class TestMainWithGadget(TestCase):
 
     def test_resume_loads_pickle_classic(self):
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ClassicBuilder',
-            EarlyExitLeaveATraceClassicBuilder))
+        self._resources.enter_context(
+            use_classic_builder(EarlyExitLeaveATraceClassicBuilder))
         self._resources.enter_context(
             patch('ubuntu_image.classic_builder.check_root_privilege'))
         main(('classic', '--until', 'prepare_image',
@@ -610,18 +666,19 @@ class TestMainWithGadget(TestCase):
         main(('--workdir', workdir, '--resume'))
         self.assertTrue(os.path.exists(os.path.join(workdir, 'success')))
 
-    @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
-            'Cannot run this test without network access')
     def test_does_not_fit(self):
         # The contents of a structure is too large for the image size.
         workdir = self._resources.enter_context(TemporaryDirectory())
+        self._resources.enter_context(
+            use_builder(MBRGadgetModelAssertionBuilder))
         # See LP: #1666580
         main(('snap', '--workdir', workdir,
               '--thru', 'load_gadget_yaml',
               self.model_assertion))
         # Make the gadget's mbr contents too big.
         path = os.path.join(workdir, 'unpack', 'gadget', 'pc-boot.img')
-        os.truncate(path, 512)
+        with open(path, 'wb') as fp:
+            fp.truncate(512)
         mock = self._resources.enter_context(patch(
             'ubuntu_image.__main__._logger.error'))
         code = main(('snap', '--workdir', workdir, '--resume'))
@@ -633,9 +690,8 @@ class TestMainWithGadget(TestCase):
 
     def test_classic_not_privileged(self):
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ClassicBuilder',
-            EarlyExitLeaveATraceClassicBuilder))
+        self._resources.enter_context(
+            use_classic_builder(EarlyExitLeaveATraceClassicBuilder))
         self._resources.enter_context(
             patch('os.geteuid', return_value=1))
         self._resources.enter_context(
@@ -660,9 +716,8 @@ class TestMainWithGadget(TestCase):
         livecd_rootfs = self._resources.enter_context(TemporaryDirectory())
         auto = os.path.join(livecd_rootfs, 'auto')
         os.mkdir(auto)
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ClassicBuilder',
-            CallLBLeaveATraceClassicBuilder))
+        self._resources.enter_context(
+            use_classic_builder(CallLBLeaveATraceClassicBuilder))
         self._resources.enter_context(
             envar('UBUNTU_IMAGE_LIVECD_ROOTFS_AUTO_PATH', auto))
         self._resources.enter_context(
@@ -706,9 +761,7 @@ echo "[MAGIC_STRING_FOR_U-I_HOOKS]" > $UBUNTU_IMAGE_HOOK_ROOTFS/foo
 """)
         os.chmod(hookfile, 0o744)
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         code = main(('--hooks-directory', hookdir,
                      '--workdir', workdir,
                      '--output-dir', workdir,
@@ -736,9 +789,7 @@ echo -n "Failed" 1>&2
 return 1
 """)
         os.chmod(hookfile, 0o744)
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         mock = self._resources.enter_context(patch(
             'ubuntu_image.__main__._logger.error'))
         code = main(('--hooks-directory', hookdir, self.model_assertion))
@@ -762,9 +813,7 @@ touch {}/success
 """.format(hookdir))
         os.chmod(hookfile, 0o744)
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            DoNothingBuilder))
+        self._resources.enter_context(use_builder(DoNothingBuilder))
         main(('--until', 'prepare_image',
               '--hooks-directory', hookdir,
               '--workdir', workdir,
@@ -782,9 +831,7 @@ touch {}/success
         # This test is responsible for checking if all the officially declared
         # hooks are called as intended, making sure none get dropped by
         # accident.
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            XXXModelAssertionBuilder))
+        self._resources.enter_context(use_builder(XXXModelAssertionBuilder))
         fire_mock = self._resources.enter_context(patch(
             'ubuntu_image.hooks.HookManager.fire'))
         code = main(('--channel', 'edge', self.model_assertion))
@@ -794,43 +841,49 @@ touch {}/success
 
 
 class TestMainWithBadGadget(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Every test runs the same builder and captures the log, so only
+        # patch those in once for the whole class.
+        cls._class_resources = ExitStack()
+        # Don't let the --debug test leave the root logger at DEBUG level,
+        # or the other test would capture the state machine's step messages.
+        cls._class_resources.enter_context(
+            patch('ubuntu_image.__main__.logging.basicConfig'))
+        cls._class_resources.enter_context(
+            use_builder(BadGadgetModelAssertionBuilder))
+        cls._log = cls._class_resources.enter_context(LogCapture())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._class_resources.close()
+
     def setUp(self):
         super().setUp()
         self._resources = ExitStack()
         self.addCleanup(self._resources.close)
-        self.model_assertion = resource_filename(
-            'ubuntu_image.tests.data', 'model.assertion')
+        # Each test starts out with nothing logged.
+        self._log.logs.clear()
+        self.model_assertion = MODEL_ASSERTION
 
-    @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
-            'Cannot run this test without network access')
     def test_bad_gadget_log(self):
-        log = self._resources.enter_context(LogCapture())
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            BadGadgetModelAssertionBuilder))
         main(('snap', '--channel', 'edge',
               '--workdir', workdir,
               self.model_assertion))
-        self.assertEqual(log.logs, [
+        self.assertEqual(self._log.logs, [
             (logging.ERROR, 'gadget.yaml parse error: '
                             'GUID structure type with non-GPT schema'),
             (logging.ERROR, 'Use --debug for more information')
             ])
 
-    @skipIf('UBUNTU_IMAGE_TESTS_NO_NETWORK' in os.environ,
-            'Cannot run this test without network access')
     def test_bad_gadget_debug_log(self):
-        log = self._resources.enter_context(LogCapture())
         workdir = self._resources.enter_context(TemporaryDirectory())
-        self._resources.enter_context(patch(
-            'ubuntu_image.__main__.ModelAssertionBuilder',
-            BadGadgetModelAssertionBuilder))
         main(('snap', '--debug',
               '--workdir', workdir,
               '--channel', 'edge',
               self.model_assertion))
-        self.assertEqual(log.logs, [
+        self.assertEqual(self._log.logs, [
             (logging.ERROR, 'uncaught exception in state machine step: '
                             '[3] load_gadget_yaml'),
             'IMAGINE THE TRACEBACK HERE',